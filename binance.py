@@ -2,6 +2,7 @@ import asyncio
 import hashlib
 import hmac
 import json
+import random
 from time import time
 from urllib.parse import urlencode
 
@@ -267,7 +268,7 @@ class BinanceBot(Bot):
             params['price'] = str(order['price'])
         if 'custom_id' in order:
             params['newClientOrderId'] = \
-                f"{order['custom_id']}_{str(int(time() * 1000))[8:]}_{int(np.random.random() * 1000)}"
+                f"{order['custom_id']}_{int(time() * 1000) % 100000}_{random.randrange(1000)}"
         o = await self.private_post(self.base_endpoint, self.endpoints['create_order'], params)
         if 'side' in o:
             return {'symbol': self.symbol,
@@ -1,31 +1,73 @@
 import asyncio
+import datetime
 import hashlib
 import hmac
-import json
+import random
+from operator import itemgetter
 from time import time
-from urllib.parse import urlencode
 
-import aiohttp
+import httpx
 import numpy as np
+import orjson
+import pandas as pd
 from dateutil import parser
 
-from passivbot import ts_to_date, print_, Bot, sort_dict_keys
-from jitted import calc_long_pnl, calc_shrt_pnl
+from passivbot import ts_to_date, print_, Bot
+from jitted import calc_equity
 
 
-def first_capitalized(s: str):
-    return s[0].upper() + s[1:].lower()
+# bybit spelling of order sides and types
+ORDER_SIDES = {'buy': 'Buy', 'sell': 'Sell'}
+ORDER_TYPES = {'limit': 'Limit', 'market': 'Market'}
 
 
-def format_tick(tick: dict) -> dict:
-    return {'trade_id': int(tick['id']),
-            'price': float(tick['price']),
-            'qty': float(tick['qty']),
-            'timestamp': date_to_ts(tick['time']),
-            'is_buyer_maker': tick['side'] == 'Sell'}
+TRADE_DTYPE = np.dtype([('trade_id', 'i8'), ('price', 'f8'), ('qty', 'f8'), ('timestamp', 'i8'),
+                        ('is_buyer_maker', '?')])
 
 
-async def fetch_ticks(cc, symbol: str, from_id: int = None, do_print=True) -> [dict]:
+get_position_fields = itemgetter('size', 'entry_price', 'leverage', 'liq_price')
+
+
+# order_link_ids start with a one letter tag and a dash, e.g. 'e-long_reentry_...',
+# so position side is looked up from first letters instead of searched for in the id
+POS_SIDE_BY_TAG = {('B', 'e'): 'long', ('B', 'c'): 'shrt', ('B', 'u'): 'unknown',
+                   ('S', 'e'): 'shrt', ('S', 'c'): 'long', ('S', 'u'): 'both'}
+
+
+def order_link_id_tag(custom_id: str) -> str:
+    return 'e' if 'entry' in custom_id else ('c' if 'close' in custom_id else 'u')
+
+
+def format_ticks(ticks: [dict]) -> np.ndarray:
+    # converts a page of trades column by column into a structured array,
+    # elements support the same field access as the tick dicts, e.g. trades[0]['price']
+    trades = np.empty(len(ticks), dtype=TRADE_DTYPE)
+    if not ticks:
+        return trades
+    ids, prices, qtys, times, sides = zip(*map(itemgetter('id', 'price', 'qty', 'time', 'side'),
+                                              ticks))
+    trades['trade_id'] = ids
+    trades['price'] = prices
+    trades['qty'] = qtys
+    trades['timestamp'] = dates_to_ts(times)
+    trades['is_buyer_maker'] = np.array(sides) == 'Sell'
+    return trades
+
+
+def merge_ticks(*pages: np.ndarray) -> np.ndarray:
+    # concatenates pages of trades, sorted by trade_id without duplicates
+    trades = np.concatenate(pages)
+    return trades[np.unique(trades['trade_id'], return_index=True)[1]]
+
+
+def drop_consecutive_same_prices(trades: np.ndarray) -> np.ndarray:
+    keep = np.ones(len(trades), dtype=np.bool_)
+    keep[1:] = (trades['price'][1:] != trades['price'][:-1]) | \
+        (trades['is_buyer_maker'][1:] != trades['is_buyer_maker'][:-1])
+    return trades[keep]
+
+
+async def fetch_ticks(cc, symbol: str, from_id: int = None, do_print=True) -> np.ndarray:
     params = {'symbol': symbol, 'limit': 1000}
     if from_id:
         params['from'] = max(0, from_id)
@@ -33,16 +75,37 @@ async def fetch_ticks(cc, symbol: str, from_id: int = None, do_print=True) -> [d
         fetched_trades = await cc.v2_public_get_trading_records(params=params)
     except Exception as e:
         print(e)
-        return []
-    trades = [format_tick(t) for t in fetched_trades['result']]
-    if do_print:
+        return np.empty(0, dtype=TRADE_DTYPE)
+    trades = format_ticks(fetched_trades['result'])
+    if do_print and len(trades):
         print_(['fetched trades', symbol, trades[0]['trade_id'],
                 ts_to_date(trades[0]['timestamp'] / 1000)])
     return trades
 
 
+def build_query(params: dict) -> str:
+    # sorted query string to be signed; bybit param values are all url safe, so unlike
+    # urlencode no percent-encoding is done
+    return '&'.join(f"{k}={v}" for k, v in sorted(params.items()))
+
+
 def date_to_ts(date: str):
-    return parser.parse(date).timestamp() * 1000
+    # bybit dates are iso 8601 utc, e.g. 2021-05-10T08:03:52.123Z; dateutil only as fallback
+    try:
+        return datetime.datetime.fromisoformat(date.replace('Z', '+00:00')).timestamp() * 1000
+    except ValueError:
+        return parser.parse(date).timestamp() * 1000
+
+
+def dates_to_ts(dates: [str]) -> np.ndarray:
+    # parses a whole column of iso 8601 utc dates at once, returns millisecond timestamps
+    try:
+        # explicit unit, pandas picks ns or us resolution for .values depending on version
+        return pd.to_datetime(list(dates), utc=True).values.astype('datetime64[ms]') \
+            .astype(np.int64)
+    except ValueError:
+        # pandas infers one format from the first date, bybit mixes fraction lengths
+        return np.array([date_to_ts(d) for d in dates]).astype(np.int64)
 
 
 class Bybit(Bot):
@@ -53,7 +116,19 @@ class Bybit(Bot):
         self.base_endpoint = 'https://api.bybit.com'
         self.endpoints = {}
         self.market_type = ''
-        self.session = aiohttp.ClientSession()
+        self.session = httpx.AsyncClient(http2=True,
+                                         limits=httpx.Limits(max_connections=100,
+                                                             max_keepalive_connections=20,
+                                                             keepalive_expiry=75),
+                                         timeout=30.0)
+        # keyed hmac state is computed once; each request signs a copy of it
+        self.hmac_proto = hmac.new(self.secret.encode('utf-8'), digestmod=hashlib.sha256)
+        self.signing_templates = {}
+        self.wallet_balance = 0.0
+        self.ts_balance_fetched = 0.0
+        self.balance_cache_ttl = 10.0
+        self.heartbeat_interval = 10.0
+        self.heartbeat_task = None
 
     def init_market_type(self):
         if self.symbol.endswith('USDT'):
@@ -95,7 +170,18 @@ class Bybit(Bot):
 
         self.endpoints['balance'] = '/v2/private/wallet/balance'
 
+        # fixed params of the polled endpoints, reused on every request
+        self.params_symbol = {'symbol': self.symbol}
+        self.params_balance = {'coin': self.quot if self.market_type == 'linear_perpetual'
+                               else self.coin}
+        self.params_ticks = {'symbol': self.symbol, 'limit': 1000}
+
     def determine_pos_side(self, o: dict) -> str:
+        if o['order_link_id'][1:2] == '-':
+            position_side = POS_SIDE_BY_TAG.get((o['side'][0], o['order_link_id'][0]))
+            if position_side is not None:
+                return position_side
+        # untagged order, e.g. placed manually, by another tool or by an older version
         side = o['side'].lower()
         if side == 'buy':
             if 'entry' in o['order_link_id']:
@@ -131,14 +217,30 @@ class Bybit(Bot):
         await super()._init()
         await self.init_order_book()
         await self.update_position()
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self.keep_session_warm())
+
+    async def close_session(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        await self.session.aclose()
+
+    async def keep_session_warm(self):
+        # cheap public request at regular intervals so pooled connections are not reaped while idle
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.public_get('/v2/public/time')
+            except Exception as e:
+                print('error with session heartbeat', e)
 
     async def init_order_book(self):
-        ticker = await self.private_get('/v2/public/tickers', {'symbol': self.symbol})
+        ticker = await self.private_get('/v2/public/tickers', self.params_symbol)
         self.ob = [float(ticker['result'][0]['bid_price']), float(ticker['result'][0]['ask_price'])]
         self.price = float(ticker['result'][0]['last_price'])
 
     async def fetch_open_orders(self) -> [dict]:
-        fetched = await self.private_get(self.endpoints['open_orders'], {'symbol': self.symbol})
+        fetched = await self.private_get(self.endpoints['open_orders'], self.params_symbol)
 
         return [{'order_id': elm['order_id'],
                  'custom_id': elm['order_link_id'],
@@ -151,24 +253,48 @@ class Bybit(Bot):
                 for elm in fetched['result']]
 
     async def public_get(self, url: str, params: dict = {}) -> dict:
-        async with self.session.get(self.base_endpoint + url, params=params) as response:
-            result = await response.text()
-        return json.loads(result)
+        response = await self.session.get(self.base_endpoint + url, params=params)
+        return orjson.loads(response.content)
+
+    def get_signing_template(self, url: str, params: dict) -> (dict, str, str):
+        # polling endpoints sign the same params every time except for the timestamp,
+        # so the converted params and the query string parts before and after the timestamp
+        # are cached per endpoint. param templates passed by identity skip even the conversion,
+        # so they must not be mutated
+        cached = self.signing_templates.get(url)
+        if cached is not None and cached[0] is params:
+            return cached[1], cached[2], cached[3]
+        converted = {'api_key': self.key}
+        for k, v in params.items():
+            if type(v) == bool:
+                converted[k] = 'true' if v else 'false'
+            elif type(v) == float:
+                converted[k] = str(v)
+            else:
+                converted[k] = v
+        if cached is not None and cached[1] == converted:
+            prefix, suffix = cached[2], cached[3]
+        else:
+            prefix = build_query({k: v for k, v in converted.items() if k < 'timestamp'})
+            suffix = build_query({k: v for k, v in converted.items() if k > 'timestamp'})
+            prefix = prefix + '&' if prefix else ''
+            suffix = '&' + suffix if suffix else ''
+        self.signing_templates[url] = (params, converted, prefix, suffix)
+        return converted, prefix, suffix
+
+    def sign(self, url: str, params: dict) -> dict:
+        # signing a cached template costs a few microseconds, far less than a hop to an executor
+        # thread would, so it stays on the event loop
+        timestamp = int(time() * 1000)
+        converted, prefix, suffix = self.get_signing_template(url, params)
+        signature = self.hmac_proto.copy()
+        signature.update(f"{prefix}timestamp={timestamp}{suffix}".encode('utf-8'))
+        return {**converted, 'timestamp': timestamp, 'sign': signature.hexdigest()}
 
     async def private_(self, type_: str, url: str, params: dict = {}) -> dict:
-        timestamp = int(time() * 1000)
-        params.update({'api_key': self.key, 'timestamp': timestamp})
-        for k in params:
-            if type(params[k]) == bool:
-                params[k] = 'true' if params[k] else 'false'
-            elif type(params[k]) == float:
-                params[k] = str(params[k])
-        params['sign'] = hmac.new(self.secret.encode('utf-8'),
-                                  urlencode(sort_dict_keys(params)).encode('utf-8'),
-                                  hashlib.sha256).hexdigest()
-        async with getattr(self.session, type_)(self.base_endpoint + url, params=params) as response:
-            result = await response.text()
-        return json.loads(result)
+        response = await self.session.request(type_.upper(), self.base_endpoint + url,
+                                              params=self.sign(url, params))
+        return orjson.loads(response.content)
 
     async def private_get(self, url: str, params: dict = {}) -> dict:
         return await self.private_('get', url, params)
@@ -176,57 +302,67 @@ class Bybit(Bot):
     async def private_post(self, url: str, params: dict = {}) -> dict:
         return await self.private_('post', url, params)
 
+    async def refresh_balance(self) -> float:
+        bal = await self.private_get(self.endpoints['balance'], self.params_balance)
+        self.wallet_balance = float(bal['result'][self.params_balance['coin']]['wallet_balance'])
+        self.ts_balance_fetched = time()
+        return self.wallet_balance
+
     async def fetch_position(self) -> dict:
-        position = {}
-        if self.market_type == 'linear_perpetual':
-            fetched, bal = await asyncio.gather(
-                self.private_get(self.endpoints['position'], {'symbol': self.symbol}),
-                self.private_get(self.endpoints['balance'], {'coin': self.quot})
+        # wallet balance only changes on fills; reuse cached value unless stale
+        balance_is_stale = time() - self.ts_balance_fetched > self.balance_cache_ttl
+        if balance_is_stale:
+            fetched, _ = await asyncio.gather(
+                self.private_get(self.endpoints['position'], self.params_symbol),
+                self.refresh_balance()
             )
-            long_pos = [e for e in fetched['result'] if e['side'] == 'Buy'][0]
-            shrt_pos = [e for e in fetched['result'] if e['side'] == 'Sell'][0]
-            position['wallet_balance'] = float(bal['result'][self.quot]['wallet_balance'])
         else:
-            fetched, bal = await asyncio.gather(
-                self.private_get(self.endpoints['position'], {'symbol': self.symbol}),
-                self.private_get(self.endpoints['balance'], {'coin': self.coin})
-            )
-            position['wallet_balance'] = float(bal['result'][self.coin]['wallet_balance'])
-            if self.market_type == 'inverse_perpetual':
-                if fetched['result']['side'] == 'Buy':
-                    long_pos = fetched['result']
-                    shrt_pos = {'size': 0.0, 'entry_price': 0.0, 'leverage': 0.0, 'liq_price': 0.0}
-                else:
-                    long_pos = {'size': 0.0, 'entry_price': 0.0, 'leverage': 0.0, 'liq_price': 0.0}
-                    shrt_pos = fetched['result']
-            elif self.market_type == 'inverse_futures':
-                long_pos = [e['data'] for e in fetched['result'] if e['data']['position_idx'] == 1][0]
-                shrt_pos = [e['data'] for e in fetched['result'] if e['data']['position_idx'] == 2][0]
-
-        position['long'] = {'size': float(long_pos['size']),
-                            'price': float(long_pos['entry_price']),
-                            'leverage': float(long_pos['leverage']),
-                            'liquidation_price': float(long_pos['liq_price'])}
-        position['shrt'] = {'size': -float(shrt_pos['size']),
-                            'price': float(shrt_pos['entry_price']),
-                            'leverage': float(shrt_pos['leverage']),
-                            'liquidation_price': float(shrt_pos['liq_price'])}
-        position['long']['upnl'] = calc_long_pnl(position['long']['price'], self.price,
-                                                 position['long']['size'], self.xk['inverse'],
-                                                 self.xk['contract_multiplier']) \
-            if position['long']['price'] != 0.0 else 0.0
-        position['shrt']['upnl'] = calc_shrt_pnl(position['shrt']['price'], self.price,
-                                                 position['shrt']['size'], self.xk['inverse'],
-                                                 self.xk['contract_multiplier']) \
-            if position['shrt']['price'] != 0.0 else 0.0
-        upnl = position['long']['upnl'] + position['shrt']['upnl']
-        position['equity'] = position['wallet_balance'] + upnl
+            fetched = await self.private_get(self.endpoints['position'], self.params_symbol)
+        if self.market_type == 'linear_perpetual':
+            for e in fetched['result']:
+                if e['side'] == 'Buy':
+                    long_pos = e
+                elif e['side'] == 'Sell':
+                    shrt_pos = e
+        elif self.market_type == 'inverse_perpetual':
+            if fetched['result']['side'] == 'Buy':
+                long_pos = fetched['result']
+                shrt_pos = {'size': 0.0, 'entry_price': 0.0, 'leverage': 0.0, 'liq_price': 0.0}
+            else:
+                long_pos = {'size': 0.0, 'entry_price': 0.0, 'leverage': 0.0, 'liq_price': 0.0}
+                shrt_pos = fetched['result']
+        elif self.market_type == 'inverse_futures':
+            for e in fetched['result']:
+                if e['data']['position_idx'] == 1:
+                    long_pos = e['data']
+                elif e['data']['position_idx'] == 2:
+                    shrt_pos = e['data']
+
+        # bybit sends most numbers as strings; parse all eight fields in one conversion
+        (long_psize, long_pprice, long_leverage, long_liq_price), \
+            (shrt_psize, shrt_pprice, shrt_leverage, shrt_liq_price) = \
+            np.array([get_position_fields(long_pos), get_position_fields(shrt_pos)],
+                     dtype=np.float64).tolist()
+        shrt_psize = -shrt_psize
+        if not balance_is_stale and self.position and \
+                (long_psize != self.position['long']['size'] or
+                 shrt_psize != self.position['shrt']['size']):
+            # position changed, so there were fills; balance is no longer valid
+            await self.refresh_balance()
+        equity, long_upnl, shrt_upnl = \
+            calc_equity(self.wallet_balance, long_psize, long_pprice, shrt_psize, shrt_pprice,
+                        self.price, self.xk['inverse'], self.xk['contract_multiplier'])
+        position = {'wallet_balance': self.wallet_balance, 'equity': equity,
+                    'long': {'size': long_psize, 'price': long_pprice, 'leverage': long_leverage,
+                             'liquidation_price': long_liq_price, 'upnl': long_upnl},
+                    'shrt': {'size': shrt_psize, 'price': shrt_pprice, 'leverage': shrt_leverage,
+                             'liquidation_price': shrt_liq_price, 'upnl': shrt_upnl}}
         return position
 
     async def execute_order(self, order: dict) -> dict:
         params = {'symbol': self.symbol,
-                  'side': first_capitalized(order['side']),
-                  'order_type': first_capitalized(order['type']),
+                  'side': ORDER_SIDES[order['side']],
+                  'order_type': ORDER_TYPES[order['type']],
                   'qty': float(order['qty']) if self.market_type == 'linear_perpetual' else int(order['qty']),
                   'close_on_trigger': False}
         if self.hedge_mode:
@@ -242,9 +378,11 @@ class Bybit(Bot):
         else:
             params['time_in_force'] = 'GoodTillCancel'
         params['order_link_id'] = \
-            f"{order['custom_id']}_{str(int(time() * 1000))[8:]}_{int(np.random.random() * 1000)}"
+            f"{order_link_id_tag(order['custom_id'])}-" \
+            f"{order['custom_id']}_{int(time() * 1000) % 100000}_{random.randrange(1000)}"
         o = await self.private_post(self.endpoints['create_order'], params)
         if o['result']:
+            self.ts_balance_fetched = 0.0
             return {'symbol': o['result']['symbol'],
                     'side': o['result']['side'].lower(),
                     'position_side': order['position_side'],
@@ -261,26 +399,73 @@ class Bybit(Bot):
                 'position_side': order['position_side'],
                 'qty': order['qty'], 'price': order['price']}
 
-    async def fetch_ticks(self, from_id: int = None, do_print: bool = True):
-        params = {'symbol': self.symbol, 'limit': 1000}
+    async def fetch_ticks(self, from_id: int = None, do_print: bool = True) -> np.ndarray:
+        params = self.params_ticks
         if from_id is not None:
-            params['from'] = max(0, from_id)
+            params = {**params, 'from': max(0, from_id)}
         try:
             ticks = await self.public_get(self.endpoints['ticks'], params)
         except Exception as e:
             print('error fetching ticks', e)
-            return []
-        try:
-            trades = list(map(format_tick, ticks['result']))
-            if do_print:
+            return np.empty(0, dtype=TRADE_DTYPE)
+        trades = format_ticks(ticks['result'])
+        if do_print:
+            if len(trades):
                 print_(['fetched trades', self.symbol, trades[0]['trade_id'],
                         ts_to_date(float(trades[0]['timestamp']) / 1000)])
-        except:
-            trades = []
-            if do_print:
+            else:
                 print_(['fetched no new trades', self.symbol])
         return trades
 
+    def drop_consecutive_same_prices(self, ticks: np.ndarray) -> np.ndarray:
+        return drop_consecutive_same_prices(ticks)
+
+    def merge_ticks(self, ticks: np.ndarray, new_ticks: np.ndarray) -> np.ndarray:
+        return merge_ticks(ticks, new_ticks)
+
+    async def fetch_ticks_page(self, from_id: int, n_tries: int = 3) -> np.ndarray:
+        # unlike fetch_ticks, a failed request is retried and finally raised instead of being
+        # returned as an empty page, which would be indistinguishable from the end of the data
+        for k in range(n_tries):
+            try:
+                ticks = await self.public_get(self.endpoints['ticks'],
+                                              {**self.params_ticks, 'from': max(0, from_id)})
+                return format_ticks(ticks['result'])
+            except Exception as e:
+                if k == n_tries - 1:
+                    raise
+                print('error fetching ticks from id', from_id, e, 'retrying...')
+                await asyncio.sleep(1.0)
+
+    async def fetch_ticks_range(self, start_id: int, end_id: int, n_parallel: int = 8,
+                                do_print: bool = True) -> np.ndarray:
+        # trade ids are sequential and a page holds up to 1000 ticks, so instead of waiting for
+        # each page's last id, n_parallel pages are requested at once from the expected offsets
+        pages = []
+        from_id = start_id
+        while from_id <= end_id:
+            froms = [from_id + i * 1000 for i in range(n_parallel) if from_id + i * 1000 <= end_id]
+            fetched = await asyncio.gather(*[self.fetch_ticks_page(f) for f in froms])
+            pages += [page for page in fetched if len(page)]
+            # continue after the last id covered without holes, in case pages were shorter;
+            # an empty page means there are no trades from that id on
+            next_id = from_id
+            for f, page in zip(froms, fetched):
+                if not len(page) or f > next_id:
+                    break
+                next_id = max(next_id, int(page[-1]['trade_id']) + 1)
+            if next_id == from_id:
+                break
+            from_id = next_id
+            if do_print:
+                print_(['fetched trades', self.symbol, 'up to id', from_id - 1])
+            if not all(len(page) for page in fetched):
+                break
+        if not pages:
+            return np.empty(0, dtype=TRADE_DTYPE)
+        trades = merge_ticks(*pages)
+        return trades[trades['trade_id'] <= end_id]
+
     def calc_margin_cost(self, qty: float, price: float) -> float:
         return qty / price / self.leverage
 
@@ -317,6 +502,12 @@ class Bybit(Bot):
             print(e)
 
     def standardize_websocket_ticks(self, data: dict) -> [dict]:
+        try:
+            return [{'price': float(e['price']), 'qty': float(e['size']),
+                     'is_buyer_maker': e['side'] == 'Sell'} for e in data['data']]
+        except (KeyError, TypeError, ValueError):
+            # malformed tick somewhere in the batch; redo it tick by tick, skipping bad ones
+            pass
         ticks = []
         for e in data['data']:
             try:
@@ -327,7 +518,7 @@ class Bybit(Bot):
 
     async def subscribe_ws(self, ws):
         params = {'op': 'subscribe', 'args': ['trade.' + self.symbol]}
-        await ws.send(json.dumps(params))
+        await ws.send(orjson.dumps(params).decode())
 
     async def transfer(self, type_: str, amount: float, asset: str = 'USDT'):
         return {'code': '-1', 'msg': 'Transferring funds not supported for Bybit'}
@@ -19,6 +19,7 @@ class Downloader:
 
     def __init__(self, config: dict):
         self.fetch_delay_seconds = 0.75
+        self.n_parallel_fetches = 8
         self.config = config
         self.price_filepath = os.path.join(config["caches_dirpath"], f"{config['session_name']}_price_cache.npy")
         self.buyer_maker_filepath = os.path.join(config["caches_dirpath"],
@@ -477,7 +478,17 @@ class Downloader:
             while current_id <= end_id and current_time <= end_time and int(
                     datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000) - current_time > 10000:
                 loop_start = time()
-                fetched_new_trades = await self.bot.fetch_ticks(int(current_id))
+                if self.config['exchange'] == 'bybit':
+                    range_end_id = int(min(end_id, current_id + self.n_parallel_fetches * 1000 - 1))
+                    try:
+                        fetched_new_trades = await self.bot.fetch_ticks_range(
+                            int(current_id), range_end_id, n_parallel=self.n_parallel_fetches)
+                    except Exception as e:
+                        print_(['Failed to fetch trades from id', current_id, 'to id', range_end_id,
+                                e, 'exiting...'])
+                        break
+                else:
+                    fetched_new_trades = await self.bot.fetch_ticks(int(current_id))
                 tf = self.transform_ticks(fetched_new_trades)
                 if tf.empty:
                     print_(["Response empty. No new trades, exiting..."])
@@ -514,7 +525,7 @@ class Downloader:
                     self.save_dataframe(df, "", True)
 
         try:
-            await self.bot.session.close()
+            await self.bot.close_session()
         except:
             pass
 
@@ -670,7 +681,7 @@ async def fetch_market_specific_settings(user: str, exchange: str, symbol: str):
         settings_from_exchange['exchange'] = 'bybit'
     else:
         raise Exception(f'unknown exchange {exchange}')
-    await bot.session.close()
+    await bot.close_session()
     if 'inverse' in bot.market_type:
         settings_from_exchange['inverse'] = True
     elif 'linear' in bot.market_type:
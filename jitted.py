@@ -300,6 +300,16 @@ def calc_shrt_pnl(entry_price, close_price, qty, inverse, contract_multiplier) -
         return abs(qty) * (entry_price - close_price)
 
 
+@njit
+def calc_equity(balance, long_psize, long_pprice, shrt_psize, shrt_pprice, last_price,
+                inverse, contract_multiplier) -> (float, float, float):
+    long_upnl = calc_long_pnl(long_pprice, last_price, long_psize, inverse, contract_multiplier) \
+        if long_pprice != 0.0 else 0.0
+    shrt_upnl = calc_shrt_pnl(shrt_pprice, last_price, shrt_psize, inverse, contract_multiplier) \
+        if shrt_pprice != 0.0 else 0.0
+    return balance + long_upnl + shrt_upnl, long_upnl, shrt_upnl
+
+
 @njit
 def calc_cost(qty, price, inverse, contract_multiplier) -> float:
     return abs(qty / price) * contract_multiplier if inverse else abs(qty * price)
@@ -10,6 +10,7 @@ from pathlib import Path
 from time import time
 
 import numpy as np
+import orjson
 import websockets
 
 import telegram_bot
@@ -197,6 +198,9 @@ class Bot:
             with open(self.log_filepath, 'a') as f:
                 f.write(json.dumps({**{'log_timestamp': time()}, **data}) + '\n')
 
+    async def close_session(self) -> None:
+        await self.session.close()
+
     async def update_open_orders(self) -> None:
         if self.ts_locked['update_open_orders'] > self.ts_released['update_open_orders']:
             return
@@ -527,19 +531,21 @@ class Bot:
                     print('flushing', key)
                     self.ts_released[key] = now
 
-    async def fetch_compressed_ticks(self):
+    def drop_consecutive_same_prices(self, ticks: [dict]) -> [dict]:
+        compressed = [ticks[0]]
+        for i in range(1, len(ticks)):
+            if ticks[i]['price'] != compressed[-1]['price'] or \
+                    ticks[i]['is_buyer_maker'] != compressed[-1]['is_buyer_maker']:
+                compressed.append(ticks[i])
+        return compressed
 
-        def drop_consecutive_same_prices(ticks_):
-            compressed_ = [ticks_[0]]
-            for i in range(1, len(ticks_)):
-                if ticks_[i]['price'] != compressed_[-1]['price'] or \
-                        ticks_[i]['is_buyer_maker'] != compressed_[-1]['is_buyer_maker']:
-                    compressed_.append(ticks_[i])
-            return compressed_
+    def merge_ticks(self, ticks: [dict], new_ticks: [dict]) -> [dict]:
+        return sorted(ticks + new_ticks, key=lambda x: x['trade_id'])
 
+    async def fetch_compressed_ticks(self):
         ticks_unabridged = await self.fetch_ticks(do_print=False)
         ticks_per_fetch = len(ticks_unabridged)
-        ticks = drop_consecutive_same_prices(ticks_unabridged)
+        ticks = self.drop_consecutive_same_prices(ticks_unabridged)
         if self.exchange == 'bybit' and self.market_type == 'linear_perpetual':
             print('\nwarning:  bybit linear usdt symbols only allows fetching most recent 1000 ticks')
             return ticks
@@ -551,13 +557,12 @@ class Bot:
             new_ticks = await self.fetch_ticks(from_id=ticks[0]['trade_id'] - ticks_per_fetch,
                                                do_print=False)
             wait_for = max(0.0, delay_between_fetches - (time() - sts))
-            ticks = drop_consecutive_same_prices(sorted(new_ticks + ticks,
-                                                        key=lambda x: x['trade_id']))
+            ticks = self.drop_consecutive_same_prices(self.merge_ticks(new_ticks, ticks))
             if len(ticks) > self.ema_span:
                 break
             await asyncio.sleep(wait_for)
         new_ticks = await self.fetch_ticks(do_print=False)
-        return drop_consecutive_same_prices(sorted(ticks + new_ticks, key=lambda x: x['trade_id']))
+        return self.drop_consecutive_same_prices(self.merge_ticks(ticks, new_ticks))
 
     async def init_indicators(self):
         ticks = await self.fetch_compressed_ticks()
@@ -619,7 +624,7 @@ class Bot:
                 if msg is None:
                     continue
                 try:
-                    ticks = self.standardize_websocket_ticks(json.loads(msg))
+                    ticks = self.standardize_websocket_ticks(orjson.loads(msg))
                     if self.process_websocket_ticks:
                         if ticks:
                             self.update_indicators(ticks)
@@ -769,7 +774,7 @@ async def main() -> None:
     signal.signal(signal.SIGINT, bot.stop)
     signal.signal(signal.SIGTERM, bot.stop)
     await start_bot(bot)
-    await bot.session.close()
+    await bot.close_session()
 
 
 if __name__ == '__main__':